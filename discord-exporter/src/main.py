@@ -1,16 +1,19 @@
 import discord
 import asyncio
-import pandas as pd
 from datetime import datetime, timezone
 import os
 import re
-from typing import List, Dict, Optional
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-import gspread
+import sqlite3
+import time
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 import pickle
 from pathlib import Path
 
+# pandas and the Google client libraries are imported where they are used,
+# so startup does not pay for them
+if TYPE_CHECKING:
+    import pandas as pd
+
 # Configuration
 class Config:
     BOT_TOKEN_ENV = 'DISCORD_BOT_TOKEN'  # Must be set in environment
@@ -38,6 +41,104 @@ class Config:
     # Performance settings
     CHANNEL_TIMEOUT_MINUTES = 5
     PROGRESS_INTERVAL = 50
+    MAX_CONCURRENT_CHANNELS = 5          # Channels fetched in parallel
+    MAX_RATE_LIMIT_RETRIES = 3           # Per channel, after discord.py's own retries
+
+    # Local message cache: re-runs only fetch history newer than what is stored.
+    # Off by default because cached reactions, authors and previews are never refreshed.
+    USE_MESSAGE_CACHE = False
+    CACHE_FILE = 'message_cache.sqlite3' # Stored in OUTPUT_DIR
+    CACHE_BATCH_SIZE = 100
+
+# Column order of the exported message table; each message becomes one
+# tuple in this order, with timestamp as a datetime and message_id as an int
+EXPORT_COLUMNS = ['timestamp', 'channel', 'author', 'preview', 'length', 'words',
+                  'reactions', 'reaction_details', 'attachments', 'urls', 'message_id']
+
+# Text normalization tables, built once
+_WS_RE = re.compile(r'\s+')
+_FIXES = {
+    'â€™':"'", 'â€œ':'"', 'â€“':'-', 'â€¢':'•',
+    'Ã¼':'ü', 'Ã±':'ñ', 'Ä±':'ı', 'ÄŸ':'ğ', 'ÅŸ':'ş', 'Ã§':'ç', 'Ã¶':'ö'
+}
+_FIX_RE = re.compile('|'.join(re.escape(k) for k in _FIXES))
+_URL_RE = re.compile(r'https?://[^\s]+')
+
+class MessageCache:
+    """SQLite store of exported rows plus how far each channel has been read."""
+
+    # Export rows are stored without their channel name, which is taken from
+    # Discord on load; the timestamp is kept as a UTC epoch
+    STORED_COLUMNS = EXPORT_COLUMNS[2:]
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                is_system INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                author TEXT, preview TEXT, length INTEGER, words INTEGER,
+                reactions INTEGER, reaction_details TEXT, attachments INTEGER, urls INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_channel ON messages (channel_id, timestamp);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                channel_id INTEGER PRIMARY KEY,
+                synced_from REAL NOT NULL,
+                include_system INTEGER NOT NULL,
+                preview_len INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL
+            );
+        ''')
+
+    def sync_state(self, channel_id: int) -> Optional[Tuple[float, int]]:
+        """Return (synced_from, last_message_id) if the cache covers the configured export."""
+        row = self.db.execute(
+            "SELECT synced_from, include_system, preview_len, last_message_id"
+            " FROM sync_state WHERE channel_id = ?",
+            (channel_id,)
+        ).fetchone()
+        if not row:
+            return None
+        synced_from, include_system, preview_len, last_id = row
+        if (synced_from > Config.START_DATE.timestamp()
+                or include_system < Config.INCLUDE_SYSTEM_MESSAGES
+                or preview_len != Config.MAX_CONTENT_PREVIEW):
+            return None
+        return synced_from, last_id
+
+    def load(self, channel_id: int, chan_name: str, last_message_id: int) -> List[tuple]:
+        """Return cached export rows for the configured date range, oldest first."""
+        # Rows past last_message_id are left over from an older sync and get refetched
+        rows = self.db.execute(
+            f"SELECT timestamp, {', '.join(self.STORED_COLUMNS)} FROM messages"
+            " WHERE channel_id = ? AND message_id <= ? AND timestamp >= ? AND timestamp < ?"
+            " AND (is_system = 0 OR ?)"
+            " ORDER BY message_id",
+            (channel_id, last_message_id, Config.START_DATE.timestamp(), Config.END_DATE.timestamp(),
+             Config.INCLUDE_SYSTEM_MESSAGES)
+        ).fetchall()
+        return [(datetime.fromtimestamp(r[0], timezone.utc), chan_name) + r[1:] for r in rows]
+
+    def save(self, channel_id: int, rows: List[Tuple[bool, tuple]], synced_from: float,
+             last_message_id: int):
+        """Store (is_system, export row) pairs and record the channel's read position."""
+        columns = ['channel_id', 'is_system', 'timestamp'] + self.STORED_COLUMNS
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO messages ({', '.join(columns)})"
+                f" VALUES ({', '.join('?' * len(columns))})",
+                [(channel_id, is_system, row[0].timestamp()) + row[2:] for is_system, row in rows]
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?)",
+                (channel_id, synced_from, Config.INCLUDE_SYSTEM_MESSAGES,
+                 Config.MAX_CONTENT_PREVIEW, last_message_id)
+            )
+
+    def close(self):
+        self.db.close()
 
 class DiscordExporter:
     def __init__(self):
@@ -47,15 +148,27 @@ class DiscordExporter:
         intents = discord.Intents.default()
         intents.message_content = True
         intents.guilds = True
-        self.client = discord.Client(intents=intents)
+        # No message cache or member chunking: history is read straight from REST
+        self.client = discord.Client(intents=intents, max_messages=None, chunk_guilds_at_startup=False)
         self.bot_token = token
 
         os.makedirs(Config.OUTPUT_DIR, exist_ok=True)
+        # Display names by user ID, shared across channels
+        self.author_names: Dict[int, str] = {}
+
+        self.cache = None
+        if Config.USE_MESSAGE_CACHE:
+            self.cache = MessageCache(f"{Config.OUTPUT_DIR}/{Config.CACHE_FILE}")
+
         self.sheets_client = None
         if Config.USE_GOOGLE_SHEETS:
             self.init_google_sheets()
 
     def init_google_sheets(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+        import gspread
+
         token_path = Path('token.pickle')
         creds = None
         if token_path.exists():
@@ -89,22 +202,18 @@ class DiscordExporter:
     def clean_text(self, text: Optional[str]) -> str:
         if not text:
             return ""
-        text = re.sub(r'\s+', ' ', text).strip()
-        fixes = {
-            'â€™':"'", 'â€œ':'"', 'â€“':'-', 'â€¢':'•',
-            'Ã¼':'ü', 'Ã±':'ñ', 'Ä±':'ı', 'ÄŸ':'ğ', 'ÅŸ':'ş', 'Ã§':'ç', 'Ã¶':'ö'
-        }
-        for old, new in fixes.items():
-            text = text.replace(old, new)
-        return text
+        text = _WS_RE.sub(' ', text).strip()
+        # Every mojibake sequence contains non-ASCII characters
+        if text.isascii():
+            return text
+        return _FIX_RE.sub(lambda m: _FIXES[m.group(0)], text)
 
     def get_channels(self) -> List[discord.TextChannel]:
         channels: List[discord.TextChannel] = []
         if Config.CHANNEL_IDS:
-            for cid in Config.CHANNEL_IDS:
-                ch = self.client.get_channel(cid)
-                if isinstance(ch, discord.TextChannel):
-                    channels.append(ch)
+            wanted = set(Config.CHANNEL_IDS)
+            for guild in self.client.guilds:
+                channels.extend(ch for ch in guild.text_channels if ch.id in wanted)
         else:
             for guild in self.client.guilds:
                 if Config.GUILD_ID and guild.id != Config.GUILD_ID:
@@ -119,72 +228,150 @@ class DiscordExporter:
     def format_reactions(self, msg: discord.Message) -> Dict:
         if not msg.reactions:
             return {'total':0, 'details':'', 'unique':0}
-        entries = [f"{r.emoji}({r.count})" for r in msg.reactions]
+        total = 0
+        entries = []
+        for r in msg.reactions:
+            total += r.count
+            entries.append(f"{r.emoji}({r.count})")
         return {
-            'total': sum(r.count for r in msg.reactions),
+            'total': total,
             'details': ' | '.join(entries),
-            'unique': len(msg.reactions)
+            'unique': len(entries)
         }
 
-    def preview(self, content: str) -> str:
-        txt = self.clean_text(content)
-        return txt if len(txt) <= Config.MAX_CONTENT_PREVIEW else txt[:Config.MAX_CONTENT_PREVIEW]+'...'
-
     def extract_urls(self, content: str) -> List[str]:
-        return re.findall(r'https?://[^\s]+', content)
+        return _URL_RE.findall(content)
 
-    async def export_channel(self, channel: discord.TextChannel) -> List[Dict]:
+    async def export_channel(self, channel: discord.TextChannel) -> Dict[str, List]:
         print(f"📥 Exporting #{channel.name}")
-        data = []
-        start = asyncio.get_event_loop().time()
+        cols: Dict[str, List] = {k: [] for k in EXPORT_COLUMNS}
+        chan_name = channel.name
+        author_names = self.author_names
+        # Locals for the per-message loop
+        clean_text = self.clean_text
+        format_reactions = self.format_reactions
+        extract_urls = self.extract_urls
+        preview_len = Config.MAX_CONTENT_PREVIEW
+        include_system = Config.INCLUDE_SYSTEM_MESSAGES
+        default_type = discord.MessageType.default
+        # Only a preview of the text is exported, so long messages are
+        # cleaned from a prefix with headroom for multi-character fixes
+        clip = preview_len * 2
+        deadline = time.monotonic() + Config.CHANNEL_TIMEOUT_MINUTES * 60
         count = 0
-        async for m in channel.history(limit=None,
-                                        after=Config.START_DATE,
-                                        before=Config.END_DATE,
-                                        oldest_first=True):
-            now = asyncio.get_event_loop().time()
-            if now - start > Config.CHANNEL_TIMEOUT_MINUTES * 60:
-                print(f"⏰ Timeout for #{channel.name}")
+        retries = 0
+        after = Config.START_DATE
+        cache = self.cache
+        synced_from, last_id = Config.START_DATE.timestamp(), None
+        pending: List[Tuple[bool, tuple]] = []
+        appends = [cols[k].append for k in EXPORT_COLUMNS]
+        if cache:
+            state = cache.sync_state(channel.id)
+            if state:
+                synced_from, last_id = state
+                for row in cache.load(channel.id, chan_name, last_id):
+                    for append, value in zip(appends, row):
+                        append(value)
+                    count += 1
+                print(f"📦 {count} cached messages for #{chan_name}")
+                if discord.utils.snowflake_time(last_id) > Config.START_DATE:
+                    after = discord.Object(id=last_id)
+        while True:
+            try:
+                async for m in channel.history(limit=None,
+                                                after=after,
+                                                before=Config.END_DATE,
+                                                oldest_first=True):
+                    after = m
+                    # A message arrived, so only consecutive rate limits count
+                    retries = 0
+                    if time.monotonic() > deadline:
+                        print(f"⏰ Timeout for #{chan_name}")
+                        break
+                    last_id = m.id
+                    if not include_system and m.type != default_type:
+                        continue
+                    react = format_reactions(m)
+                    content = m.content
+                    urls = extract_urls(content)
+                    if len(content) > clip:
+                        text = clean_text(content[:clip])
+                        # Too short after collapsing whitespace to be a faithful prefix
+                        if len(text) <= preview_len + 2:
+                            text = clean_text(content)
+                        words = len(content.split())
+                    else:
+                        text = clean_text(content)
+                        # Whitespace in text is already collapsed to single spaces
+                        words = text.count(' ') + 1 if text else 0
+                    preview = text if len(text) <= preview_len else text[:preview_len]+'...'
+                    if m.webhook_id:
+                        # Webhooks post under a per-message name with one shared ID
+                        author = str(m.author)
+                    else:
+                        author = author_names.get(m.author.id)
+                        if author is None:
+                            author = author_names[m.author.id] = str(m.author)
+                    row = (m.created_at, chan_name, author, preview, len(content), words,
+                           react['total'], react['details'], len(m.attachments), len(urls), m.id)
+                    for append, value in zip(appends, row):
+                        append(value)
+                    if cache:
+                        pending.append((m.type != default_type, row))
+                        if len(pending) >= Config.CACHE_BATCH_SIZE:
+                            cache.save(channel.id, pending, synced_from, last_id)
+                            pending.clear()
+                    count += 1
+                    if count % Config.PROGRESS_INTERVAL == 0:
+                        print(f"📊 Processed {count} messages from #{chan_name}")
                 break
-            if not Config.INCLUDE_SYSTEM_MESSAGES and m.type != discord.MessageType.default:
-                continue
-            react = self.format_reactions(m)
-            urls = self.extract_urls(m.content)
-            data.append({
-                'timestamp': m.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                'channel': channel.name,
-                'author': str(m.author),
-                'preview': self.preview(m.content),
-                'length': len(m.content),
-                'words': len(m.content.split()),
-                'reactions': react['total'],
-                'reaction_details': react['details'],
-                'attachments': len(m.attachments),
-                'urls': len(urls),
-                'message_id': str(m.id)
-            })
-            count += 1
-            if count % Config.PROGRESS_INTERVAL == 0:
-                print(f"📊 Processed {count} messages")
-            start = now
-        print(f"✅ {len(data)} messages from #{channel.name}")
-        return data
-
-    def upload_sheets(self, df: pd.DataFrame) -> Optional[str]:
+            except (discord.RateLimited, discord.HTTPException) as e:
+                if isinstance(e, discord.HTTPException) and e.status != 429:
+                    raise
+                retries += 1
+                if retries > Config.MAX_RATE_LIMIT_RETRIES:
+                    # Fail the channel rather than return a silently short export
+                    print(f"❌ Still rate limited on #{chan_name} after {Config.MAX_RATE_LIMIT_RETRIES} retries")
+                    raise
+                retry_after = getattr(e, 'retry_after', 5)
+                if time.monotonic() + retry_after > deadline:
+                    print(f"⏰ Timeout for #{chan_name}")
+                    break
+                # Resume after the last message seen once the limit clears
+                print(f"⏳ Rate limited on #{chan_name}, retrying in {retry_after:.1f}s")
+                await asyncio.sleep(retry_after)
+        if cache and last_id is not None:
+            cache.save(channel.id, pending, synced_from, last_id)
+        print(f"✅ {count} messages from #{chan_name}")
+        return cols
+
+    def upload_sheets(self, df: 'pd.DataFrame') -> Optional[str]:
         try:
             now = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
             title = f"Discord Export {now}"
             print(f"📤 Creating Google Sheet: {title}")
             sheet = self.sheets_client.create(title)
-            ws = sheet.worksheets()
-            for extra in ws[1:]: sheet.del_worksheet(extra)
-            main = ws[0]; main.update_title('All Messages')
+            # A new spreadsheet holds a single tab with sheetId 0
+            requests = [{'updateSheetProperties': {
+                'properties': {'sheetId': 0, 'title': 'All Messages'},
+                'fields': 'title'
+            }}]
             for tab in ['Channel Summary','Daily Activity','Author Activity']:
-                sheet.add_worksheet(title=tab, rows=1000, cols=20)
-            main.clear()
+                requests.append({'addSheet': {'properties': {
+                    'title': tab,
+                    'gridProperties': {'rowCount': 1000, 'columnCount': 20}
+                }}})
+            sheet.batch_update({'requests': requests})
             cols = ['timestamp','channel','author','preview','reactions','reaction_details','attachments']
-            core = df[cols]
-            main.update('A1', [core.columns.tolist()] + core.values.tolist())
+            # itertuples yields native Python scalars per row, skipping the
+            # object-array copy that .values makes of a mixed-dtype frame
+            rows = [cols] + [list(r) for r in df[cols].itertuples(index=False, name=None)]
+            sheet.values_batch_update({
+                'valueInputOption': 'RAW',
+                'data': [
+                    {'range': "'All Messages'!A1", 'values': rows}
+                ]
+            })
             url = f"https://docs.google.com/spreadsheets/d/{sheet.id}"
             print(f"✅ Sheet URL: {url}")
             return url
@@ -192,18 +379,34 @@ class DiscordExporter:
             print(f"❌ Sheet upload error: {e}")
             return None
 
-    def save_local(self, df: pd.DataFrame):
+    def save_local(self, df: 'pd.DataFrame'):
         print("💾 Saving locally...")
-        path = f"{Config.OUTPUT_DIR}/export_combined.xlsx"
-        df.to_excel(path, index=False)
+        path = f"{Config.OUTPUT_DIR}/export_combined.parquet"
+        df.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
         print(f"Saved: {path}")
 
     async def export_messages(self):
+        import pandas as pd
+
         chans = self.get_channels()
-        all_msgs = []
-        for ch in chans:
-            all_msgs.extend(await self.export_channel(ch))
-        df_all = pd.DataFrame(all_msgs)
+        sem = asyncio.Semaphore(Config.MAX_CONCURRENT_CHANNELS)
+
+        async def bounded(ch: discord.TextChannel) -> Dict[str, List]:
+            async with sem:
+                return await self.export_channel(ch)
+
+        results = await asyncio.gather(*(bounded(ch) for ch in chans), return_exceptions=True)
+        all_cols: Dict[str, List] = {k: [] for k in EXPORT_COLUMNS}
+        for ch, res in zip(chans, results):
+            if isinstance(res, BaseException):
+                print(f"❌ Failed to export #{ch.name}: {res}")
+                continue
+            for k, values in res.items():
+                all_cols[k].extend(values)
+        df_all = pd.DataFrame(all_cols)
+        # Format all timestamps in one vectorized pass rather than per message
+        df_all['timestamp'] = pd.to_datetime(df_all['timestamp'], utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
+        df_all['message_id'] = df_all['message_id'].astype(str)
         if Config.USE_GOOGLE_SHEETS and self.sheets_client:
             url = self.upload_sheets(df_all)
             if not url:
@@ -218,6 +421,8 @@ class DiscordExporter:
         finally:
             if not self.client.is_closed():
                 await self.client.close()
+            if self.cache:
+                self.cache.close()
 
 async def main():
     exporter = DiscordExporter()